@@ -0,0 +1,54 @@
+"""Application settings loaded once from the environment"""
+import os
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+
+# Production process managers (systemd, docker) provide the environment directly
+if os.getenv("ENV", "dev").lower() == "dev":
+    load_dotenv()
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    Immutable snapshot of the environment configuration, built once at import time.
+    """
+    MONGODB_URI: Optional[str]
+    ENV: str = "dev"
+    DB_NAME: str = "finance_db"
+    MAX_UPLOAD_SIZE: int = 1 << 20
+    SAVE_AT_FRONT: bool = False
+    MONGO_MAX_POOL: int = 200
+    MONGO_MIN_POOL: int = 10
+    MONGO_MAX_CONNECTING: int = 4
+    OPENAI_API_KEY: Optional[str] = None
+    INSERT_BATCH_SIZE: int = 500
+    REDIS_URL: Optional[str] = None
+    TEXT_JOB_WORKERS: int = 2
+    HOST: str = "0.0.0.0"
+    PORT: int = 8000
+    WEB_CONCURRENCY: int = 1
+    RELOAD: bool = False
+    SERVE_STATIC: bool = True
+    CORS_ORIGINS: Tuple[str, ...] = ("http://localhost:3000",)
+
+settings = Settings(
+    MONGODB_URI=os.getenv("MONGODB_URI"),
+    ENV=os.getenv("ENV", "dev").lower(),
+    DB_NAME=os.getenv("DB_NAME", "finance_db"),
+    MAX_UPLOAD_SIZE=int(os.getenv("MAX_UPLOAD_SIZE", str(1 << 20))),
+    SAVE_AT_FRONT=os.getenv("SAVE_AT_FRONT", "false").lower() == "true",
+    MONGO_MAX_POOL=int(os.getenv("MONGO_MAX_POOL", "200")),
+    MONGO_MIN_POOL=int(os.getenv("MONGO_MIN_POOL", "10")),
+    MONGO_MAX_CONNECTING=int(os.getenv("MONGO_MAX_CONNECTING", "4")),
+    OPENAI_API_KEY=os.getenv("OPENAI_API_KEY"),
+    INSERT_BATCH_SIZE=int(os.getenv("INSERT_BATCH_SIZE", "500")),
+    REDIS_URL=os.getenv("REDIS_URL"),
+    TEXT_JOB_WORKERS=int(os.getenv("TEXT_JOB_WORKERS", "2")),
+    HOST=os.getenv("HOST", "0.0.0.0"),
+    PORT=int(os.getenv("PORT", "8000")),
+    WEB_CONCURRENCY=int(os.getenv("WEB_CONCURRENCY", "1")),
+    RELOAD=os.getenv("RELOAD", "false").lower() == "true",
+    SERVE_STATIC=os.getenv("SERVE_STATIC", "true").lower() == "true",
+    CORS_ORIGINS=tuple(origin.strip() for origin in os.getenv("CORS_ORIGINS", "http://localhost:3000").split(",") if origin.strip()),
+)
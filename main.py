@@ -1,43 +1,63 @@
 """Main FastAPI application"""
-import os
+import asyncio
 import logging
-from fastapi import FastAPI, Request, HTTPException, Depends
+import logging.config
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.middleware.exceptions import ExceptionMiddleware
 from contextlib import asynccontextmanager
-from motor.motor_asyncio import AsyncIOMotorClient
-from dotenv import load_dotenv
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.collection import AsyncCollection
+from config import settings
+from utils import cache, openai_agent
+from utils.database import app_state, close_client, get_client, get_expenses_collection, is_mongo_ready
 from routes import router as api_router
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response
-
-from rich.logging import RichHandler
+from services import expenses_service, jobs_service
 
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-from slowapi.middleware import SlowAPIMiddleware
+
+IS_DEV = settings.ENV == "dev"
+
+if IS_DEV:
+    # Rich output is pleasant locally but renders every record through its console/markup parser
+    DEFAULT_FORMATTER = {
+        "format": "%(name)s - %(message)s",
+        "datefmt": "%Y-%m-%d %H:%M:%S",
+    }
+    DEFAULT_HANDLER = {
+        "class": "rich.logging.RichHandler",
+        "formatter": "default",
+        "level": "DEBUG",
+        "rich_tracebacks": True,
+        "show_time": True,
+        "show_path": False,
+        "log_time_format": "%Y-%m-%d %H:%M:%S",
+        "markup": True
+    }
+else:
+    DEFAULT_FORMATTER = {
+        "format": "%(asctime)s %(levelname)s %(name)s: %(message)s",
+        "datefmt": "%Y-%m-%d %H:%M:%S",
+    }
+    DEFAULT_HANDLER = {
+        "class": "logging.StreamHandler",
+        "formatter": "default",
+        "level": "DEBUG",
+    }
 
 LOGGING_CONFIG = {
     "version": 1,
     "disable_existing_loggers": False,
     "formatters": {
-        "default": {
-            "format": "%(name)s - %(message)s",
-            "datefmt": "%Y-%m-%d %H:%M:%S",
-        },
+        "default": DEFAULT_FORMATTER,
     },
     "handlers": {
-        "default": {
-            "class": "rich.logging.RichHandler",
-            "formatter": "default",
-            "level": "DEBUG",
-            "rich_tracebacks": True,
-            "show_time": True,
-            "show_path": False,
-            "log_time_format": "%Y-%m-%d %H:%M:%S",
-            "markup": True
-        },
+        "default": DEFAULT_HANDLER,
     },
     "loggers": {
         "uvicorn": {
@@ -52,7 +72,8 @@ LOGGING_CONFIG = {
         },
         "uvicorn.access": {
             "handlers": ["default"],
-            "level": "INFO", 
+            # One access record per request is only worth paying for in development
+            "level": "INFO" if IS_DEV else "WARNING", 
             "propagate": False,
         },
         "": {
@@ -67,82 +88,196 @@ logging.config.dictConfig(LOGGING_CONFIG)
 
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-
-MONGODB_URI = os.getenv("MONGODB_URI")
-DB_NAME = os.getenv("DB_NAME", "finance_db")
-MAX_UPLOAD_SIZE = 1 * 1024 * 1024
-UPLOAD_ENDPOINT_PATH = "/api/upload"
-SAVE_AT_FRONT = os.getenv("SAVE_AT_FRONT", "false").lower() == "true"
+MAX_UPLOAD_SIZE = settings.MAX_UPLOAD_SIZE
+UPLOAD_ENDPOINT_PATH = "/api/upload-file"
+_CONTENT_LENGTH = b"content-length"
+_UPLOAD_TOO_LARGE_BODY = f"Maximum file upload size limit ({MAX_UPLOAD_SIZE / (1024*1024):.1f} MB) exceeded.".encode()
+_INVALID_CONTENT_LENGTH_BODY = b"Invalid Content-Length header."
+# Health probes and the favicon never need CORS, compression or upload checks
+_FAST_PATHS = frozenset({"/health", "/favicon.ico"})
+# Startup ping retries back off exponentially from the first delay up to the cap (seconds)
+MONGO_PING_RETRY_DELAY = 1.0
+MONGO_PING_RETRY_MAX_DELAY = 30.0
 
-if not MONGODB_URI:
+if not settings.MONGODB_URI:
     logger.error("MONGODB_URI environment variable not set! Database connection will fail.")
 
-app_state = {}
-
 limiter = Limiter(key_func=get_remote_address)
 DEFAULT_RATE_LIMIT = "15/minute"
 
-class LimitUploadSizeMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        if request.url.path == UPLOAD_ENDPOINT_PATH:
-            content_length_header = request.headers.get("content-length")
-            if content_length_header:
-                try:
-                    content_length = int(content_length_header)
-                    if content_length > MAX_UPLOAD_SIZE:
-                        logger.warning(f"Upload rejected: File size {content_length} exceeds limit {MAX_UPLOAD_SIZE}.")
-                        return Response(f"Maximum file upload size limit ({MAX_UPLOAD_SIZE / (1024*1024):.1f} MB) exceeded.", status_code=413)
-                except ValueError:
-                    logger.warning("Upload rejected: Invalid Content-Length header.")
-                    return Response("Invalid Content-Length header.", status_code=400)
-
-        response = await call_next(request)
-        return response
+class LimitUploadSizeMiddleware:
+    """
+    Pure ASGI middleware rejecting uploads larger than MAX_UPLOAD_SIZE: up front from Content-Length when present,
+    otherwise (e.g. Transfer-Encoding: chunked) as soon as the body received so far exceeds the limit.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Compare the decoded path the router matches on; raw_path may be percent-encoded (or absent)
+        if scope.get("path") != UPLOAD_ENDPOINT_PATH:
+            return await self.app(scope, receive, send)
+
+        content_length_header = None
+        for name, value in scope["headers"]:
+            if name == _CONTENT_LENGTH:
+                content_length_header = value
+                break
+
+        if content_length_header is not None:
+            try:
+                content_length = int(content_length_header)
+            except ValueError:
+                logger.warning("Upload rejected: Invalid Content-Length header.")
+                return await self._send_plain_response(send, 400, _INVALID_CONTENT_LENGTH_BODY)
+            if content_length > MAX_UPLOAD_SIZE:
+                logger.warning("Upload rejected: File size %d exceeds limit %d.", content_length, MAX_UPLOAD_SIZE)
+                return await self._send_plain_response(send, 413, _UPLOAD_TOO_LARGE_BODY)
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_UPLOAD_SIZE:
+                    logger.warning("Upload rejected: Body exceeded limit %d while streaming.", MAX_UPLOAD_SIZE)
+                    # Raised into the body parser; FastAPI re-raises HTTPExceptions and the app renders the 413
+                    raise HTTPException(status_code=413, detail=_UPLOAD_TOO_LARGE_BODY.decode())
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except HTTPException as exc:
+            # Backstop for a 413 that escaped the app without being rendered
+            if exc.status_code != 413 or response_started:
+                raise
+            await self._send_plain_response(send, 413, _UPLOAD_TOO_LARGE_BODY)
+
+    @staticmethod
+    async def _send_plain_response(send, status_code: int, body: bytes):
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+async def _wait_ready(client: AsyncMongoClient, collection: AsyncCollection, ready: asyncio.Event):
+    """
+    Pings MongoDB in the background until it answers (retrying with capped backoff, until cancelled at shutdown),
+    then flags the connection as ready and ensures indexes.
+    """
+    # Routes rely on the ready flag alone, so it must never be set without a bound collection
+    if collection is None:
+        logger.error("MongoDB readiness not signalled: the expenses collection is not bound.")
+        return
+    delay = MONGO_PING_RETRY_DELAY
+    while True:
+        try:
+            await client.admin.command('ping')
+            break
+        except Exception as e:
+            logger.error("MongoDB ping failed, retrying in %.0fs: %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MONGO_PING_RETRY_MAX_DELAY)
+    ready.set()
+    pool_options = client.options.pool_options
+    logger.info("MongoDB ping successful. Connection pool: min=%d, max=%d, max_connecting=%d.", pool_options.min_pool_size, pool_options.max_pool_size, pool_options.max_connecting)
+    await expenses_service.ensure_indexes(collection)
+
+class FastPathMiddleware:
+    """
+    Pure ASGI middleware sending _FAST_PATHS requests straight to fast_app, skipping the rest of the stack.
+    fast_app must still turn HTTPExceptions (405, 404) into responses, see the registration below.
+    """
+    def __init__(self, app, fast_app):
+        self.app = app
+        self.fast_app = fast_app
+
+    async def __call__(self, scope, receive, send):
+        if scope.get("path") in _FAST_PATHS:
+            return await self.fast_app(scope, receive, send)
+        await self.app(scope, receive, send)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    logger.info(f"Connecting to MongoDB at {MONGODB_URI}...")
+    app.state.save_at_front = settings.SAVE_AT_FRONT
+    logger.info(f"Configuration: SAVE_AT_FRONT = {settings.SAVE_AT_FRONT}")
+    logger.info(f"Connecting to MongoDB at {settings.MONGODB_URI}...")
+    get_expenses_collection.cache_clear()
+    cache.connect()
+    app_state["mongo_ready"] = asyncio.Event()
     try:
-        app_state["db_client"] = AsyncIOMotorClient(MONGODB_URI)
-        app_state["db"] = app_state["db_client"][DB_NAME]
+        app_state["db_client"] = get_client()
+        app_state["db"] = app_state["db_client"][settings.DB_NAME]
         app_state["expenses_collection"] = app_state["db"].get_collection("expenses")
-        logger.info(f"Successfully connected to MongoDB database: {DB_NAME}")
-        app_state["save_at_front"] = SAVE_AT_FRONT
-        logger.info(f"Configuration: SAVE_AT_FRONT = {SAVE_AT_FRONT}")
-        await app_state["db_client"].admin.command('ping')
-        logger.info("MongoDB ping successful.")
+        logger.info(f"Successfully connected to MongoDB database: {settings.DB_NAME}")
+        # Don't block startup on the network round trip; Mongo-backed routes answer 503 until ready
+        app_state["mongo_ping_task"] = asyncio.create_task(
+            _wait_ready(app_state["db_client"], app_state["expenses_collection"], app_state["mongo_ready"])
+        )
     except Exception as e:
         logger.error(f"Failed to connect to MongoDB: {e}")
         app_state["db_client"] = None
         app_state["db"] = None
         app_state["expenses_collection"] = None
+    get_expenses_collection.cache_clear()
+    
+    jobs_service.start_workers()
+    openai_agent.start_batcher()
     
     yield
     
+    await jobs_service.stop_workers()
+    await openai_agent.stop_batcher()
+    ping_task = app_state.get("mongo_ping_task")
+    if ping_task and not ping_task.done():
+        ping_task.cancel()
     if app_state.get("db_client"):
         logger.info("Closing MongoDB connection...")
-        app_state["db_client"].close()
+        await close_client()
         logger.info("MongoDB connection closed.")
+    app_state.clear()
+    get_expenses_collection.cache_clear()
+    await cache.close()
 
 app = FastAPI(
     title="Finance Manager API",
     description="API for managing expenses from files and text.",
     version="0.1.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+# Middleware runs outer-to-inner in reverse order of registration:
+#   FastPathMiddleware -> CORSMiddleware -> GZipMiddleware -> LimitUploadSizeMiddleware -> routes
+# FastPathMiddleware hands health/favicon requests to the router wrapped only in the app's exception handlers, and
+# CORS answers OPTIONS preflights before any upload-size checks run.
+app.add_middleware(LimitUploadSizeMiddleware)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=list(settings.CORS_ORIGINS),
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
-app.add_middleware(LimitUploadSizeMiddleware)
+app.add_middleware(FastPathMiddleware, fast_app=ExceptionMiddleware(app.router, handlers=app.exception_handlers))
 
 app.include_router(
     api_router, 
@@ -150,23 +285,28 @@ app.include_router(
     tags=["api"],
 )
 
-app.mount("/", StaticFiles(directory="public", html=True), name="static")
+@app.get("/health", summary="Health Check", description="Liveness probe reporting whether MongoDB has answered its startup ping.")
+async def health():
+    """Reports process liveness and MongoDB readiness without touching the database."""
+    return {"status": "ok", "mongo_ready": is_mongo_ready()}
 
-@app.middleware("http")
-async def add_app_config_to_request(request: Request, call_next):
-    """Adds database connection and configuration settings to the request state."""
-    request.state.db_client = app_state.get("db_client")
-    request.state.db = app_state.get("db")
-    request.state.expenses_collection = app_state.get("expenses_collection")
-    request.state.save_at_front = app_state.get("save_at_front", False)
-    response = await call_next(request)
-    return response
+# In production, public/ is best served by a reverse proxy (see README) with SERVE_STATIC=false
+if settings.SERVE_STATIC:
+    app.mount("/", StaticFiles(directory="public", html=True), name="static")
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
+    # WEB_CONCURRENCY follows the usual (2 x CPU cores) + 1 worker heuristic in production;
+    # RELOAD is meant for local development only and cannot be combined with multiple workers.
     uvicorn.run(
         "main:app", 
-        host="0.0.0.0", 
-        port=8000, 
-        reload=True
-    ) 
\ No newline at end of file
+        host=settings.HOST, 
+        port=settings.PORT, 
+        workers=settings.WEB_CONCURRENCY,
+        reload=settings.RELOAD,
+        # uvloop/httptools ship with uvicorn[standard]; uvloop is unavailable on Windows.
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        log_config=None
+    )
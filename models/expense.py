@@ -1,18 +1,29 @@
 """Pydantic model for Expense data"""
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, field_validator
 from datetime import date
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from typing import Literal, Optional
 
+CENT = Decimal("0.01")
+
 class Expense(BaseModel):
     """
     Represents a single expense or income transaction.
     """
+    model_config = ConfigDict(populate_by_name=True, from_attributes=True)
+
     id: Optional[str] = None
     date: date
     description: str
     value: float
     in_out: Literal['in', 'out']
 
-    class Config:
-        populate_by_name = True
-        from_attributes = True 
\ No newline at end of file
+    @field_validator('value')
+    @classmethod
+    def round_to_cents(cls, value: float) -> float:
+        """Normalizes the amount to whole cents so equal amounts always compare (and deduplicate) equal."""
+        try:
+            return float(Decimal(repr(value)).quantize(CENT, rounding=ROUND_HALF_UP))
+        except InvalidOperation:
+            # Too many digits to quantize (about 1e26 and up); a ValueError becomes a per-item validation error
+            raise ValueError("value is too large")
@@ -1,10 +1,15 @@
 """API Routes for expenses"""
-from fastapi import APIRouter, UploadFile, File, HTTPException, Body, Depends, Request, Query
-from typing import List, Annotated, Optional
-from services import expenses_service
+from fastapi import APIRouter, UploadFile, File, HTTPException, Body, Request, Query, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import AsyncIterator, Dict, List, Annotated, Optional
+from services import expenses_service, jobs_service
 from models.expense import Expense
-from motor.motor_asyncio import AsyncIOMotorCollection
+from utils import cache, database
+from pymongo.asynchronous.collection import AsyncCollection
+import asyncio
+import hashlib
 import logging
+import orjson
 
 # Pydantic model for text input
 from pydantic import BaseModel
@@ -15,30 +20,76 @@ class TextInput(BaseModel):
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-# --- Dependency Function --- 
-def get_expenses_collection(request: Request) -> AsyncIOMotorCollection:
-    """Dependency to get the MongoDB expenses collection from the request state."""
-    collection = request.state.expenses_collection
-    if collection is None:
-        logger.error("Expenses collection not found in application state. Check MongoDB connection.")
-        raise HTTPException(status_code=503, detail="Database service not available.")
-    return collection
+# In-flight /process-text runs keyed by the SHA-256 of the submitted text
+_inflight_text_tasks: Dict[str, asyncio.Task] = {}
 
-# Type hint for the dependency
-ExpensesCollectionDep = Annotated[AsyncIOMotorCollection, Depends(get_expenses_collection)]
+ALLOWED_UPLOAD_CONTENT_TYPES = frozenset({"text/csv", "text/plain"})
+ALLOWED_UPLOAD_EXTENSIONS = (".csv", ".txt")
+
+def _has_allowed_extension(filename: Optional[str]) -> bool:
+    """Checks the upload extension, lowercasing the name only when the exact-case check fails."""
+    if not filename:
+        return False
+    return filename.endswith(ALLOWED_UPLOAD_EXTENSIONS) or filename.lower().endswith(ALLOWED_UPLOAD_EXTENSIONS)
+
+STREAM_CHUNK_ITEMS = 500
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Browsers keep the listing but revalidate it with If-None-Match on every load, so an upload shows up immediately
+EXPENSES_CACHE_CONTROL = "private, no-cache"
+
+# --- Collection Accessor --- 
+def get_expenses_collection() -> AsyncCollection:
+    """Returns the MongoDB expenses collection bound at startup, or raises 503 while MongoDB is unavailable."""
+    # Readiness is only ever flagged after startup bound the collection, so this also covers a failed connect
+    if not database.is_mongo_ready():
+        logger.warning("Expenses collection requested before MongoDB answered its startup ping.")
+        raise HTTPException(status_code=503, detail="Database service not ready.")
+    return database.get_expenses_collection()
+
+async def _stream_json_array(first_expense: Optional[Expense], expenses: AsyncIterator[Expense]) -> AsyncIterator[bytes]:
+    """Encodes expenses as one JSON array, sending STREAM_CHUNK_ITEMS expenses per body chunk."""
+    if first_expense is None:
+        yield b"[]"
+        return
+    chunk = [b"[", orjson.dumps(first_expense.model_dump())]
+    async for expense in expenses:
+        chunk.append(b",")
+        chunk.append(orjson.dumps(expense.model_dump()))
+        if len(chunk) >= 2 * STREAM_CHUNK_ITEMS:
+            yield b"".join(chunk)
+            chunk = []
+    chunk.append(b"]")
+    yield b"".join(chunk)
+
+async def _stream_ndjson(first_expense: Optional[Expense], expenses: AsyncIterator[Expense]) -> AsyncIterator[bytes]:
+    """Encodes expenses as newline-delimited JSON, sending STREAM_CHUNK_ITEMS lines per body chunk."""
+    if first_expense is None:
+        return
+    chunk = [orjson.dumps(first_expense.model_dump(), option=orjson.OPT_APPEND_NEWLINE)]
+    async for expense in expenses:
+        chunk.append(orjson.dumps(expense.model_dump(), option=orjson.OPT_APPEND_NEWLINE))
+        if len(chunk) >= STREAM_CHUNK_ITEMS:
+            yield b"".join(chunk)
+            chunk = []
+    if chunk:
+        yield b"".join(chunk)
 
 # --- API Routes --- 
 
-@router.get("/expenses", response_model=List[Expense], summary="Get All Expenses", description="Retrieves all expense records from the database, sorted by date descending by default.")
+@router.get("/expenses", response_model=List[Expense], summary="Get All Expenses", description="Retrieves all expense records from the database, sorted by date descending by default. Served from the Redis cache when enabled (see the X-Cache header), with an ETag for conditional requests. Send Accept: application/x-ndjson to stream one expense per line instead.")
 async def get_expenses(
-    collection: ExpensesCollectionDep,
+    request: Request,
     sort_by: Optional[str] = Query('date', description="Field to sort by (e.g., 'date', 'value')."), 
-    sort_order: Optional[int] = Query(-1, description="Sort order: 1 for ascending, -1 for descending.")
+    sort_order: Optional[int] = Query(-1, description="Sort order: 1 for ascending, -1 for descending."),
+    skip: int = Query(0, ge=0, description="Number of expenses to skip, for pagination."),
+    limit: Optional[int] = Query(None, ge=1, description="Maximum number of expenses to return. All of them when omitted.")
 ) -> List[Expense]:
     """
-    Fetches all expenses, allowing sorting via query parameters.
+    Fetches all expenses, allowing sorting and pagination via query parameters.
     """
-    logger.info(f"GET /expenses endpoint called. Sorting by '{sort_by}' order '{sort_order}'")
+    logger.info("GET /expenses endpoint called. Sorting by '%s' order '%s'", sort_by, sort_order)
+    collection = get_expenses_collection()
     try:
         allowed_sort_fields = ['date', 'description', 'value', 'in_out']
         if sort_by not in allowed_sort_fields:
@@ -47,8 +98,34 @@ async def get_expenses(
         if sort_order not in [1, -1]:
              raise HTTPException(status_code=400, detail="Invalid sort_order value. Use 1 for ascending or -1 for descending.")
 
-        expenses = await expenses_service.get_all_expenses_from_db(collection, sort_by=sort_by, sort_order=sort_order)
-        return expenses
+        if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+            # One JSON object per line lets clients process rows as they arrive; never cached
+            expenses = expenses_service.iter_expenses_from_db(collection, sort_by=sort_by, sort_order=sort_order, skip=skip, limit=limit)
+            first_expense = await anext(expenses, None)
+            return StreamingResponse(_stream_ndjson(first_expense, expenses), media_type=NDJSON_MEDIA_TYPE)
+
+        version = await cache.get_expenses_version()
+        if version is None:
+            # Nothing to cache, so stream the array as the cursor delivers it instead of building it in memory
+            expenses = expenses_service.iter_expenses_from_db(collection, sort_by=sort_by, sort_order=sort_order, skip=skip, limit=limit)
+            # Pull the first expense now so a database error still becomes a 503 before any bytes are sent
+            first_expense = await anext(expenses, None)
+            return StreamingResponse(_stream_json_array(first_expense, expenses), media_type="application/json")
+
+        # The version is bumped by every write route, so it identifies the listing without reading it
+        etag = f'W/"{version}-{sort_by}-{sort_order}-{skip}-{limit or 0}"'
+        headers = {"ETag": etag, "Cache-Control": EXPENSES_CACHE_CONTROL}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        cached_body = await cache.get_expenses_listing(version, sort_by, sort_order, skip, limit)
+        if cached_body is not None:
+            return Response(content=cached_body, media_type="application/json", headers={**headers, "X-Cache": "HIT"})
+
+        expenses = await expenses_service.get_all_expenses_from_db(collection, sort_by=sort_by, sort_order=sort_order, skip=skip, limit=limit)
+        body = orjson.dumps([expense.model_dump() for expense in expenses])
+        await cache.set_expenses_listing(version, sort_by, sort_order, body, skip, limit)
+        return Response(content=body, media_type="application/json", headers={**headers, "X-Cache": "MISS"})
     except ConnectionError as ce:
         logger.error(f"Connection error fetching expenses: {ce}")
         raise HTTPException(status_code=503, detail=f"Database connection error: {ce}")
@@ -56,23 +133,35 @@ async def get_expenses(
         logger.exception(f"Unexpected error fetching expenses: {e}")
         raise HTTPException(status_code=500, detail="An unexpected server error occurred while fetching expenses.")
 
+@router.get("/expenses/summary", summary="Summarize Expenses", description="Returns the number of expenses and the in, out and net totals, computed by the database.")
+async def get_expenses_summary():
+    """Aggregates the totals server-side instead of fetching every expense."""
+    collection = get_expenses_collection()
+    try:
+        return await expenses_service.summarize_expenses(collection)
+    except ConnectionError as ce:
+        logger.error(f"Connection error summarizing expenses: {ce}")
+        raise HTTPException(status_code=503, detail=f"Database connection error: {ce}")
+
 @router.post("/upload-file", summary="Process Expense File", description="Uploads a single CSV or TXT file, processes it, and stores the expenses.")
 async def upload_expense_file(request: Request, file: UploadFile = File(...)):
     """
     Handles uploading of a single expense file (.csv, .txt).
     Validates file, sends to service for processing and storage using the injected DB collection.
     """
-    collection = get_expenses_collection(request)
-    save_at_front = request.state.save_at_front
-    logger.info(f"POST /upload-file endpoint called for file: {file.filename} - SaveAtFront: {save_at_front}")
+    collection = get_expenses_collection()
+    save_at_front = request.app.state.save_at_front
+    logger.info("POST /upload-file endpoint called for file: %s - SaveAtFront: %s", file.filename, save_at_front)
     
-    if not file.content_type in ["text/csv", "text/plain"] and not file.filename.lower().endswith(('.csv', '.txt')):
-        logger.warning(f"Invalid file type attempted upload: {file.filename} ({file.content_type})")
+    if file.content_type not in ALLOWED_UPLOAD_CONTENT_TYPES and not _has_allowed_extension(file.filename):
+        logger.warning("Invalid file type attempted upload: %s (%s)", file.filename, file.content_type)
         raise HTTPException(status_code=400, detail=f"Invalid file type: {file.content_type}. Please upload CSV or TXT.")
     
     try:
         result = await expenses_service.process_uploaded_file(collection, file, save_at_front=save_at_front)
-        logger.info(f"File {file.filename} processed. Result: {result}")
+        logger.info("File %s processed. Result: %s", file.filename, result)
+        if result.get("added_count"):
+            await cache.invalidate_expenses()
 
         # Determine appropriate status code based on service result
         status_code = 200
@@ -82,9 +171,11 @@ async def upload_expense_file(request: Request, file: UploadFile = File(...)):
             status_code = 207
 
         if status_code >= 400:
-             raise HTTPException(status_code=status_code, detail=result)
+             # Same {"detail": ...} body HTTPException produced, encoded once by orjson without the exception handler round trip
+             return ORJSONResponse({"detail": result}, status_code=status_code)
         else:
-             return result 
+             # Encoded by orjson directly (dates included), skipping FastAPI's jsonable_encoder pass over the result
+             return ORJSONResponse(result)
 
     except ValueError as ve:
         logger.error(f"ValueError processing file {file.filename}: {ve}")
@@ -104,16 +195,28 @@ async def process_expense_text(request: Request, text_input: Annotated[TextInput
     Handles direct text input for expense processing using the injected DB collection.
     Sends text to service layer for AI processing and storage.
     """
-    collection = get_expenses_collection(request)
-    save_at_front = request.state.save_at_front
-    logger.info(f"POST /process-text endpoint called with text: {text_input.text_input[:50]}... - SaveAtFront: {save_at_front}")
+    collection = get_expenses_collection()
+    save_at_front = request.app.state.save_at_front
+    # %.50s truncates while formatting, so nothing is sliced or built when INFO is disabled
+    logger.info("POST /process-text endpoint called with text: %.50s... - SaveAtFront: %s", text_input.text_input, save_at_front)
     
     if not text_input.text_input or not text_input.text_input.strip():
         raise HTTPException(status_code=400, detail="Text input cannot be empty.")
 
     try:
-        result = await expenses_service.process_text_input(collection, text_input.text_input, save_at_front=save_at_front)
-        logger.info(f"Text input processed. Result: {result}")
+        # Identical texts submitted concurrently share a single AI/DB run instead of each calling the agent
+        text_key = hashlib.sha256(text_input.text_input.encode()).hexdigest()
+        task = _inflight_text_tasks.get(text_key)
+        if task is None:
+            task = asyncio.ensure_future(expenses_service.process_text_input(collection, text_input.text_input, save_at_front=save_at_front))
+            _inflight_text_tasks[text_key] = task
+            task.add_done_callback(lambda _: _inflight_text_tasks.pop(text_key, None))
+        else:
+            logger.info("Identical text input already in flight. Awaiting its result.")
+        result = await asyncio.shield(task)
+        logger.info("Text input processed. Result: %s", result)
+        if result.get("added_count"):
+            await cache.invalidate_expenses()
 
         # Determine status code similar to file upload
         status_code = 200
@@ -123,9 +226,10 @@ async def process_expense_text(request: Request, text_input: Annotated[TextInput
             status_code = 207
             
         if status_code >= 400:
-             raise HTTPException(status_code=status_code, detail=result)
+             # Same {"detail": ...} body HTTPException produced, encoded once by orjson without the exception handler round trip
+             return ORJSONResponse({"detail": result}, status_code=status_code)
         else:
-             return result
+             return ORJSONResponse(result)
 
     except ValueError as ve:
         logger.error(f"ValueError processing text input: {ve}")
@@ -137,13 +241,43 @@ async def process_expense_text(request: Request, text_input: Annotated[TextInput
         logger.exception(f"Unexpected error processing text input: {e}")
         raise ConnectionError("Unexpected server error processing text input.")
 
+@router.post("/process-text/jobs", status_code=202, summary="Queue Expense Text", description="Queues raw text input for background AI processing and returns a job id to poll.")
+async def queue_expense_text(request: Request, text_input: Annotated[TextInput, Body(...)]):
+    """
+    Queues direct text input for background processing so the request doesn't wait on the AI agent.
+    The result is available from GET /jobs/{job_id}.
+    """
+    get_expenses_collection()
+    save_at_front = request.app.state.save_at_front
+    logger.info("POST /process-text/jobs endpoint called with text: %.50s... - SaveAtFront: %s", text_input.text_input, save_at_front)
+
+    if not text_input.text_input or not text_input.text_input.strip():
+        raise HTTPException(status_code=400, detail="Text input cannot be empty.")
+
+    try:
+        job_id = await jobs_service.enqueue_text(text_input.text_input, save_at_front=save_at_front)
+    except RuntimeError as re:
+        logger.error(f"Could not queue text input: {re}")
+        raise HTTPException(status_code=503, detail=str(re))
+    return {"job_id": job_id, "status": "queued"}
+
+@router.get("/jobs/{job_id}", summary="Get Job Status", description="Returns the status of a queued text processing job and its result once completed.")
+async def get_job_status(job_id: str):
+    """Looks up a background text processing job."""
+    job = await jobs_service.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
 @router.delete("/expenses/all", summary="Delete All Expenses", description="Deletes all expense records from the database. Use with caution!")
-async def delete_all_expenses_route(collection: ExpensesCollectionDep):
+async def delete_all_expenses_route():
     """API endpoint to delete all expenses."""
+    collection = get_expenses_collection()
     logger.warning("DELETE /expenses/all endpoint called. This will clear the database.")
     try:
         result = await expenses_service.delete_all_expenses(collection)
-        logger.info(f"Delete all expenses result: {result}")
+        logger.info("Delete all expenses result: %s", result)
+        await cache.invalidate_expenses()
         if result["status"] == "success":
             return result
         else:
@@ -159,11 +293,12 @@ async def delete_all_expenses_route(collection: ExpensesCollectionDep):
 @router.post("/expenses/clear")
 async def clear_database(request: Request):
     """API endpoint to clear all expenses from the database."""
-    collection = get_expenses_collection(request)
+    collection = get_expenses_collection()
     logger.warning("POST /expenses/clear endpoint called. This will clear the database.")
     try:
         result = await expenses_service.delete_all_expenses(collection)
-        logger.info(f"Clear database result: {result}")
+        logger.info("Clear database result: %s", result)
+        await cache.invalidate_expenses()
         if result["status"] == "success":
             return result
         else:
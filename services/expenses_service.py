@@ -1,43 +1,329 @@
 """Service layer for handling expense-related logic."""
+import asyncio
 import logging
+import math
+import codecs
 import csv
-import io
-import json
+import operator
 from fastapi import UploadFile
-from typing import List, Dict, Any
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, List, Dict, Any, Optional, Tuple
 from models.expense import Expense
-from utils.openai_agent import process_text_with_agent, determine_sign_convention
-from motor.motor_asyncio import AsyncIOMotorCollection
-from pydantic import ValidationError
-from datetime import date, datetime
+from utils.openai_agent import extract_text_chunked, extract_text_batched, determine_sign_convention
+from pymongo.asynchronous.collection import AsyncCollection
+from pydantic import TypeAdapter, ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from config import settings
+from datetime import date, datetime, time
 
 logger = logging.getLogger(__name__)
 
+UPLOAD_CHUNK_SIZE = 64 * 1024
+CSV_EXPECTED_HEADERS = ['date', 'description', 'value']
+CSV_OPTIONAL_HEADERS = ['in_out']
+# Built once: the required set for the header check, and every column worth keeping, in output order
+_CSV_REQUIRED_HEADERS = frozenset(CSV_EXPECTED_HEADERS)
+_CSV_WANTED_HEADERS = tuple(CSV_EXPECTED_HEADERS + CSV_OPTIONAL_HEADERS)
+# The sign convention analysis of a CSV sees its first SIGN_SAMPLE_LINES lines plus up to twice as many spread
+# evenly over the rest
+SIGN_SAMPLE_LINES = 50
+# Imports at least this large are validated in a worker thread instead of on the event loop
+VALIDATE_IN_THREAD_MIN_ITEMS = 500
+# Stored dates are datetimes at midnight (BSON has no date-only type)
+MIDNIGHT = time(0, 0)
+
 # --- Database Interaction Functions (Depend on collection passed from route) ---
 
-async def get_all_expenses_from_db(collection: AsyncIOMotorCollection, sort_by: str = 'date', sort_order: int = -1) -> List[Expense]:
-    """Fetches all expenses from the provided MongoDB collection, sorted as specified."""
-    logger.info(f"Fetching all expenses from collection '{collection.name}', sorting by {sort_by} ({'desc' if sort_order == -1 else 'asc'})...")
+# Index used to serve each allowed sort field (the compound date index also covers date sorts)
+SORT_INDEXES = {
+    "date": ([("date", -1), ("in_out", 1)], "date_in_out"),
+    "value": ([("value", -1)], "value_desc"),
+    "description": ([("description", 1)], "description_asc"),
+    "in_out": ([("in_out", 1)], "in_out_asc"),
+}
+# Serves paginated date listings, whose _id tie-breaker the date_in_out index can't provide (walked either way)
+PAGED_SORT_INDEXES = {
+    "date": ([("date", -1), ("_id", -1)], "date_id"),
+}
+# Serves the upsert filters in _upsert_batch with one index seek per document
+DUPLICATE_CHECK_INDEX = ([("date", 1), ("description", 1), ("value", 1)], "dup_check")
+# Passed to every bulk write: unordered writes let the server apply the operations in parallel and carry on
+# past a failed document, which the per-document error reporting relies on. The collection's write concern is
+# kept as is; expenses are financial records, so acknowledged writes are worth their cost here.
+BULK_WRITE_KWARGS = {"ordered": False, "bypass_document_validation": False}
+# Sub-batches of one import written at the same time, so a huge import can't take over the connection pool
+INSERT_MAX_CONCURRENCY = 4
+
+# Names of the indexes confirmed by ensure_indexes in this process; only these are used as query hints
+_ensured_indexes = set()
+
+async def ensure_indexes(collection: AsyncCollection) -> None:
+    """Creates the indexes backing the expense queries. create_index is idempotent, so this is safe on every startup."""
+    for keys, name in [*SORT_INDEXES.values(), *PAGED_SORT_INDEXES.values(), DUPLICATE_CHECK_INDEX]:
+        try:
+            await collection.create_index(keys, name=name)
+            _ensured_indexes.add(name)
+        except OperationFailure as e:
+            logger.error("Failed to create index '%s' on collection '%s': %s", name, collection.name, e)
+    logger.info(f"Indexes ensured on collection '{collection.name}': {', '.join(sorted(_ensured_indexes))}")
+
+EXPENSE_LIST_ADAPTER = TypeAdapter(List[Expense])
+# Every stored expense was validated by add_multiple_expenses_to_db on its way in, so listings skip re-validation.
+# Set to False if documents can reach the collection another way (e.g. a migration adding fields).
+TRUSTED_DB_READS = True
+EXPENSE_PROJECTION = {"_id": 1, "date": 1, "description": 1, "value": 1, "in_out": 1}
+# Documents fetched per cursor round trip (and validated per call) when streaming the listing
+LISTING_BATCH_SIZE = 1000
+
+def _listing_cursor(collection: AsyncCollection, sort_by: str, sort_order: int, skip: int = 0, limit: Optional[int] = None):
+    """
+    Builds the projected, sorted (and index-hinted, once the index is confirmed) cursor over the expenses,
+    optionally restricted to one page. Pages add _id as a tie-breaker so equal sort values never straddle pages.
+    """
+    if skip or limit:
+        cursor = collection.find({}, projection=EXPENSE_PROJECTION, skip=skip, limit=limit or 0)
+        cursor = cursor.sort([(sort_by, sort_order), ("_id", sort_order)])
+        index_name = PAGED_SORT_INDEXES.get(sort_by, (None, None))[1]
+    else:
+        cursor = collection.find({}, projection=EXPENSE_PROJECTION).sort(sort_by, sort_order)
+        index_name = SORT_INDEXES.get(sort_by, (None, None))[1]
+    if index_name in _ensured_indexes:
+        cursor = cursor.hint(index_name)
+    return cursor
+
+def _validate_listing(docs: List[Dict[str, Any]]) -> List[Expense]:
+    """Normalizes stored documents in place and validates them (unless trusted), skipping (and logging) invalid ones."""
+    for doc in docs:
+        if '_id' in doc: doc['id'] = str(doc.pop('_id'))
+        if 'date' in doc and isinstance(doc['date'], datetime):
+            doc['date'] = doc['date'].date()
+    if TRUSTED_DB_READS:
+        return [Expense.model_construct(**doc) for doc in docs]
+    try:
+        # One validator call for the whole list instead of a model constructor call per document
+        return EXPENSE_LIST_ADAPTER.validate_python(docs)
+    except ValidationError:
+        pass
+    # Rare: only now pay for per-document validation, to skip the invalid documents
     expenses = []
+    for doc in docs:
+        try:
+            expenses.append(Expense(**doc))
+        except ValidationError as e:
+            logger.error("Data validation error for document ID %s: %s", doc.get('id', 'N/A'), e)
+    return expenses
+
+async def get_all_expenses_from_db(
+    collection: AsyncCollection,
+    sort_by: str = 'date',
+    sort_order: int = -1,
+    skip: int = 0,
+    limit: Optional[int] = None
+) -> List[Expense]:
+    """Fetches all expenses (or one page of them) from the provided MongoDB collection, sorted as specified."""
+    logger.info("Fetching all expenses from collection '%s', sorting by %s (%s)...", collection.name, sort_by, "desc" if sort_order == -1 else "asc")
     try:
-        cursor = collection.find().sort(sort_by, sort_order)
-        async for doc in cursor:
-            try:
-                if '_id' in doc: doc['id'] = str(doc.pop('_id'))
-                if 'date' in doc and isinstance(doc['date'], datetime):
-                    doc['date'] = doc['date'].date()
-                expenses.append(Expense(**doc))
-            except ValidationError as e:
-                logger.error(f"Data validation error for document ID {doc.get('id', 'N/A')}: {e}")
-                continue
-        logger.info(f"Fetched {len(expenses)} expenses successfully.")
+        # Drain the cursor in one call instead of awaiting per document
+        docs = await _listing_cursor(collection, sort_by, sort_order, skip, limit).to_list(length=None)
+        expenses = _validate_listing(docs)
+        logger.info("Fetched %d expenses successfully.", len(expenses))
     except Exception as e:
         logger.error(f"Database error fetching expenses: {e}")
         raise ConnectionError(f"Database error fetching expenses: {e}")
     return expenses
 
+async def iter_expenses_from_db(
+    collection: AsyncCollection,
+    sort_by: str = 'date',
+    sort_order: int = -1,
+    skip: int = 0,
+    limit: Optional[int] = None
+) -> AsyncIterator[Expense]:
+    """
+    Yields expenses as the cursor delivers them, validating LISTING_BATCH_SIZE documents at a time,
+    so memory stays bounded by one batch instead of the whole collection.
+    """
+    logger.info("Streaming all expenses from collection '%s', sorting by %s (%s)...", collection.name, sort_by, "desc" if sort_order == -1 else "asc")
+    cursor = _listing_cursor(collection, sort_by, sort_order, skip, limit).batch_size(LISTING_BATCH_SIZE)
+    batch = []
+    while True:
+        try:
+            doc = await anext(cursor, None)
+        except Exception as e:
+            logger.error(f"Database error fetching expenses: {e}")
+            raise ConnectionError(f"Database error fetching expenses: {e}")
+        if doc is not None:
+            batch.append(doc)
+            if len(batch) < LISTING_BATCH_SIZE:
+                continue
+        for expense in _validate_listing(batch):
+            yield expense
+        if doc is None:
+            return
+        batch = []
+
+# Same split as the frontend totals: negative values are money out, everything else money in
+SUMMARY_PIPELINE = [
+    {"$group": {
+        "_id": None,
+        "count": {"$sum": 1},
+        "sum_in": {"$sum": {"$cond": [{"$gte": ["$value", 0]}, "$value", 0]}},
+        "sum_out": {"$sum": {"$cond": [{"$lt": ["$value", 0]}, "$value", 0]}},
+        "sum_net": {"$sum": "$value"},
+    }},
+    {"$project": {"_id": 0}},
+]
+
+async def summarize_expenses(collection: AsyncCollection) -> Dict[str, Any]:
+    """Returns the expense count and in/out/net totals, computed server-side without fetching any document."""
+    try:
+        cursor = await collection.aggregate(SUMMARY_PIPELINE)
+        summary = await anext(cursor, None)
+    except Exception as e:
+        logger.error(f"Database error summarizing expenses: {e}")
+        raise ConnectionError(f"Database error summarizing expenses: {e}")
+    if summary is None:
+        return {"count": 0, "sum_in": 0.0, "sum_out": 0.0, "sum_net": 0.0}
+    # Float sums drift in the last digits; values are stored rounded to cents
+    return {"count": summary["count"], **{key: round(summary[key], 2) for key in ("sum_in", "sum_out", "sum_net")}}
+
+def _snip(expense_data: Dict[str, Any]) -> str:
+    """Returns the first 20 characters of an item's description for error messages; only called on error paths."""
+    return (expense_data.get("description") or "")[:20]
+
+def _date_from_str(date_input: str) -> date:
+    """Parses YYYY-MM-DD with the C fast path, falling back to strptime for e.g. unpadded '2024-1-5'."""
+    try:
+        return date.fromisoformat(date_input)
+    except ValueError:
+        return datetime.strptime(date_input, '%Y-%m-%d').date()
+
+# Exact-type dispatch for item dates; anything else (including None) is reported as unusable
+_DATE_PARSERS = {
+    str: _date_from_str,
+    date: lambda date_input: date_input,
+    datetime: datetime.date,
+}
+
+def _parse_item_date(item_index: int, expense_data: Dict[str, Any], errors: List[str]) -> Optional[date]:
+    """Returns the item's date as a date object, or records why it is unusable in errors and returns None."""
+    date_input = expense_data.get('date')
+    parser = _DATE_PARSERS.get(type(date_input))
+    if parser is not None:
+        try:
+            return parser(date_input)
+        except ValueError:
+            logger.warning("Skipping item #%d due to invalid date format: %s", item_index, date_input)
+            errors.append(f"Item #{item_index} ({_snip(expense_data)}...): Invalid date format.")
+            return None
+    if date_input is not None:
+        logger.warning("Skipping item #%d due to unexpected date type: %s", item_index, type(date_input))
+        errors.append(f"Item #{item_index} ({_snip(expense_data)}...): Invalid date type.")
+        return None
+    logger.warning("Skipping item #%d due to missing or unparseable date.", item_index)
+    errors.append(f"Item #{item_index} ({_snip(expense_data)}...): Missing or unparseable date.")
+    return None
+
+def _duplicate_key(model: Expense) -> tuple:
+    """Returns the (date, description, value) tuple that identifies an expense for duplicate detection."""
+    return (datetime.combine(model.date, MIDNIGHT), model.description, model.value)
+
+async def _upsert_batch(collection: AsyncCollection, batch: List[Dict[str, Any]]) -> Tuple[Dict[int, str], set, List[str]]:
+    """
+    Inserts the documents of one sub-batch that are not stored yet, in a single unordered bulk_write of upserts.
+    Returns the inserted ids by batch index, the indexes that failed, and the per-document errors.
+    """
+    operations = [
+        UpdateOne({"date": doc["date"], "description": doc["description"], "value": doc["value"]}, {"$setOnInsert": doc}, upsert=True)
+        for doc in batch
+    ]
+    try:
+        result = await collection.bulk_write(operations, **BULK_WRITE_KWARGS)
+        upserted = {index: str(oid) for index, oid in result.upserted_ids.items()}
+        failed_indexes = set()
+        errors = []
+    except BulkWriteError as bwe:
+        # Unordered writes keep going past failures
+        write_errors = bwe.details.get("writeErrors", [])
+        upserted = {item["index"]: str(item["_id"]) for item in bwe.details.get("upserted", [])}
+        failed_indexes = {err["index"] for err in write_errors}
+        logger.error(f"Bulk upsert batch partially failed: {len(write_errors)} write errors.")
+        errors = [
+            f"Database error inserting ({_snip(batch[err['index']])}...): {err.get('errmsg')}"
+            for err in write_errors
+        ]
+    except Exception as e:
+        logger.error(f"Database error during bulk upsert: {e}")
+        return {}, set(range(len(batch))), [f"Database error during bulk insert: {e}"]
+    return upserted, failed_indexes, errors
+
+def _validate_items(expenses_data: List[Dict[str, Any]], invert_signs: bool) -> Tuple[List[Tuple[int, Expense]], List[str]]:
+    """Normalizes and validates raw items into (item index, Expense) pairs, collecting an error for each rejected item."""
+    errors = []
+    cleaned = []
+    # Local aliases keep global/attribute lookups out of the per-item loop
+    parse_date, to_float, isfinite = _parse_item_date, float, math.isfinite
+    for item_index, expense_data in enumerate(expenses_data):
+        if not isinstance(expense_data, dict):
+            logger.error("Unexpected item #%d of type %s", item_index, type(expense_data))
+            errors.append(f"Item #{item_index}: Unexpected processing error.")
+            continue
+        if 'id' in expense_data: del expense_data['id']
+        if '_id' in expense_data: del expense_data['_id']
+
+        parsed_date = parse_date(item_index, expense_data, errors)
+        if parsed_date is None:
+            continue
+        expense_data['date'] = parsed_date
+
+        value_input = expense_data.get('value')
+        try:
+            expense_data['value'] = to_float(value_input)
+            # 'inf'/'nan' parse as floats but can't be rounded to cents by the model validator
+            if not isfinite(expense_data['value']):
+                raise ValueError(value_input)
+        except (ValueError, TypeError):
+            logger.warning("Skipping item #%d due to invalid value: %s", item_index, value_input)
+            errors.append(f"Item #{item_index} ({_snip(expense_data)}...): Invalid or missing value.")
+            continue
+        
+        if 'in_out' not in expense_data or expense_data['in_out'] not in ['in', 'out']:
+             expense_data['in_out'] = 'in' if expense_data['value'] >= 0 else 'out'
+
+        cleaned.append((item_index, expense_data))
+
+    # One validator call for the whole import; only a failing import pays for a second pass over the valid items
+    try:
+        models = EXPENSE_LIST_ADAPTER.validate_python([expense_data for _, expense_data in cleaned])
+    except ValidationError as e:
+        item_errors: Dict[int, List[str]] = {}
+        for err in e.errors(include_url=False):
+            field = ".".join(str(part) for part in err["loc"][1:])
+            item_errors.setdefault(err["loc"][0], []).append(f"{field}: {err['msg']}")
+        # The cleaning loop appended exactly one error per item it dropped, in input order; pair those errors with
+        # their item indexes so the validation errors can be merged in and the whole list reported in input order
+        cleaned_indexes = {item_index for item_index, _ in cleaned}
+        dropped_indexes = [item_index for item_index in range(len(expenses_data)) if item_index not in cleaned_indexes]
+        indexed_errors = list(zip(dropped_indexes, errors))
+        for position, messages in item_errors.items():
+            item_index, expense_data = cleaned[position]
+            logger.warning("Skipping item #%d due to validation error: %s", item_index, messages)
+            indexed_errors.append((item_index, f"Item #{item_index} ({_snip(expense_data)}...): Validation error - {'; '.join(messages)}"))
+        indexed_errors.sort(key=lambda indexed_error: indexed_error[0])
+        errors = [message for _, message in indexed_errors]
+        cleaned = [item for position, item in enumerate(cleaned) if position not in item_errors]
+        models = EXPENSE_LIST_ADAPTER.validate_python([expense_data for _, expense_data in cleaned])
+
+    candidates = []
+    for (item_index, _), expense_model in zip(cleaned, models):
+        if invert_signs:
+            expense_model.value *= -1
+            expense_model.in_out = 'in' if expense_model.value >= 0 else 'out'
+        candidates.append((item_index, expense_model))
+    return candidates, errors
+
 async def add_multiple_expenses_to_db(
-    collection: AsyncIOMotorCollection,
+    collection: AsyncCollection,
     expenses_data: List[Dict[str, Any]],
     invert_signs: bool = False,
     save_at_front: bool = False
@@ -46,108 +332,81 @@ async def add_multiple_expenses_to_db(
     if not expenses_data:
         return {"status": "no_data", "added_count": 0, "skipped_count": 0, "errors": [], "duplicates_info": [], "inserted_ids": [], "processed_expenses": []}
 
-    logger.info(f"Attempting to process {len(expenses_data)} expenses. Save to DB: {not save_at_front}")
+    logger.info("Attempting to process %d expenses. Save to DB: %s", len(expenses_data), not save_at_front)
     added_count = 0
     skipped_count = 0
-    errors = []
     valid_expense_models = []
     skipped_duplicates_info = []
 
-    for item_index, expense_data in enumerate(expenses_data):
-        try:
-            if 'id' in expense_data: del expense_data['id']
-            if '_id' in expense_data: del expense_data['_id']
-            
-            date_input = expense_data.get('date')
-            parsed_date = None
-            if isinstance(date_input, str):
-                try:
-                    parsed_date = datetime.strptime(date_input, '%Y-%m-%d').date()
-                except ValueError:
-                    logger.warning(f"Skipping item #{item_index} due to invalid date format: {date_input}")
-                    errors.append(f"Item #{item_index} ({expense_data.get('description', '')[:20]}...): Invalid date format.")
-                    continue
-            elif isinstance(date_input, date):
-                parsed_date = date_input
-            elif date_input is not None:
-                 logger.warning(f"Skipping item #{item_index} due to unexpected date type: {type(date_input)}")
-                 errors.append(f"Item #{item_index} ({expense_data.get('description', '')[:20]}...): Invalid date type.")
-                 continue
-
-            if parsed_date is None:
-                 logger.warning(f"Skipping item #{item_index} due to missing or unparseable date.")
-                 errors.append(f"Item #{item_index} ({expense_data.get('description', '')[:20]}...): Missing or unparseable date.")
-                 continue
-            else:
-                expense_data['date'] = parsed_date
-
-            if not save_at_front:
-                query_date = datetime.combine(parsed_date, datetime.min.time())
-                duplicate_check_filter = {
-                    "date": query_date,
-                    "description": expense_data.get("description"),
-                    "value": expense_data.get("value")
-                }
-                existing_doc = await collection.find_one(duplicate_check_filter)
-                if existing_doc:
-                    logger.warning(f"Skipping item #{item_index} as duplicate found (DB check): {duplicate_check_filter}")
-                    skipped_count += 1
-                    skipped_duplicates_info.append(f"DupDB: {expense_data.get('date')} - {expense_data.get('description', '')[:20]}...")
-                    continue
-
-            value_input = expense_data.get('value')
-            try:
-                expense_data['value'] = float(value_input)
-            except (ValueError, TypeError):
-                logger.warning(f"Skipping item #{item_index} due to invalid value: {value_input}")
-                errors.append(f"Item #{item_index} ({expense_data.get('description', '')[:20]}...): Invalid or missing value.")
-                continue
-            
-            if 'in_out' not in expense_data or expense_data['in_out'] not in ['in', 'out']:
-                 expense_data['in_out'] = 'in' if expense_data['value'] >= 0 else 'out'
-            
-            expense_model = Expense(**expense_data)
-
-            if invert_signs:
-                expense_model.value *= -1
-                expense_model.in_out = 'in' if expense_model.value >= 0 else 'out'
+    # Validation is pure CPU work; for large imports run it in a thread so other requests keep being served
+    if len(expenses_data) >= VALIDATE_IN_THREAD_MIN_ITEMS:
+        candidates, errors = await asyncio.to_thread(_validate_items, expenses_data, invert_signs)
+    else:
+        candidates, errors = _validate_items(expenses_data, invert_signs)
 
-            valid_expense_models.append(expense_model)
+    def skip_duplicate(item_index: int, model: Expense) -> None:
+        nonlocal skipped_count
+        logger.warning("Skipping item #%d as duplicate found (DB check): %s - %s", item_index, model.date, model.description)
+        skipped_count += 1
+        skipped_duplicates_info.append(f"DupDB: {model.date} - {model.description[:20]}...")
 
-        except ValidationError as e:
-            logger.warning(f"Skipping item #{item_index} due to validation error: {e}")
-            errors.append(f"Item #{item_index} ({expense_data.get('description', '')[:20]}...): Validation error - {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error processing item #{item_index}: {e}")
-            errors.append(f"Item #{item_index} ({expense_data.get('description', '')[:20]}...): Unexpected processing error.")
+    def skip_import_duplicate(item_index: int, first_index: int, model: Expense) -> None:
+        nonlocal skipped_count
+        logger.warning("Skipping item #%d as a repeat of item #%d in the same import: %s - %s", item_index, first_index, model.date, model.description)
+        skipped_count += 1
+        skipped_duplicates_info.append(f"DupImport: item #{item_index} repeats item #{first_index} ({model.date} - {model.description[:20]}...)")
 
     inserted_ids = []
-    if not save_at_front and valid_expense_models:
-        valid_expenses_for_db = []
-        for model in valid_expense_models:
-             expense_dict = model.model_dump(exclude_none=True)
-             expense_dict['date'] = datetime.combine(model.date, datetime.min.time())
-             valid_expenses_for_db.append(expense_dict)
-
-        if valid_expenses_for_db:
-             logger.info(f"Attempting bulk insert of {len(valid_expenses_for_db)} valid expenses into DB.")
-             try:
-                 result = await collection.insert_many(valid_expenses_for_db, ordered=False)
-                 added_count = len(result.inserted_ids)
-                 inserted_ids = [str(oid) for oid in result.inserted_ids]
-                 logger.info(f"Bulk insert successful. Added {added_count} expenses to DB.")
-             except Exception as e:
-                 logger.error(f"Database error during bulk insert: {e}")
-                 errors.append(f"Database error during bulk insert: {e}")
-                 added_count = 0
-        else:
-             logger.info("No valid expenses to insert into DB.")
-
-    elif save_at_front:
+    if save_at_front:
         logger.info("Skipping database insertion because SAVE_AT_FRONT is True.")
-        added_count = 0
-    else: 
-         logger.info("No valid expenses were processed.")
+        valid_expense_models = [model for _, model in candidates]
+    else:
+        # Keys are compared on the values that would be stored, so CSV strings and inverted signs match too
+        candidate_keys = [_duplicate_key(model) for _, model in candidates]
+        # Rows repeating an earlier row of the same import (same date, description and value) are stored once;
+        # each repeat is reported as skipped together with the item it repeats
+        first_index_by_key: Dict[tuple, int] = {}
+        accepted = []
+        for (item_index, model), key in zip(candidates, candidate_keys):
+            first_index = first_index_by_key.setdefault(key, item_index)
+            if first_index != item_index:
+                skip_import_duplicate(item_index, first_index, model)
+                continue
+            accepted.append((item_index, model, key))
+
+        if accepted:
+            valid_expenses_for_db = [
+                {"date": key[0], "description": key[1], "value": key[2], "in_out": model.in_out}
+                for _, model, key in accepted
+            ]
+            logger.info("Attempting bulk upsert of %d valid expenses into DB in batches of %d.", len(valid_expenses_for_db), settings.INSERT_BATCH_SIZE)
+            starts = range(0, len(valid_expenses_for_db), settings.INSERT_BATCH_SIZE)
+            # Sub-batches are independent unordered writes, so they go out concurrently over pooled connections;
+            # the upserts insert only documents not stored yet, so no separate duplicate lookup is needed
+            semaphore = asyncio.Semaphore(INSERT_MAX_CONCURRENCY)
+
+            async def upsert_bounded(batch: List[Dict[str, Any]]) -> Tuple[Dict[int, str], set, List[str]]:
+                async with semaphore:
+                    return await _upsert_batch(collection, batch)
+
+            results = await asyncio.gather(*(
+                upsert_bounded(valid_expenses_for_db[start:start + settings.INSERT_BATCH_SIZE]) for start in starts
+            ))
+            for start, (upserted, failed_indexes, batch_errors) in zip(starts, results):
+                errors.extend(batch_errors)
+                for offset, (item_index, model, _) in enumerate(accepted[start:start + settings.INSERT_BATCH_SIZE]):
+                    if offset in upserted:
+                        inserted_ids.append(upserted[offset])
+                        valid_expense_models.append(model)
+                    elif offset in failed_indexes:
+                        valid_expense_models.append(model)
+                    else:
+                        # Matched an existing document instead of inserting one
+                        skip_duplicate(item_index, model)
+            added_count = len(inserted_ids)
+            logger.info("Bulk upsert finished. Added %d expenses to DB.", added_count)
+        else:
+            logger.info("No valid expenses were processed.")
 
     final_status = "error"
     if not errors and (added_count > 0 or save_at_front):
@@ -157,10 +416,12 @@ async def add_multiple_expenses_to_db(
     elif not valid_expense_models and not errors:
         final_status = "no_data"
 
-    logger.info(f"Finished processing expenses. Status: {final_status}, Added to DB: {added_count}, Processed: {len(valid_expense_models)}, Errors: {len(errors)}, Skipped Dups (DB): {skipped_count}")
+    logger.info("Finished processing expenses. Status: %s, Added to DB: %d, Processed: %d, Errors: %d, Skipped Dups (DB): %d", final_status, added_count, len(valid_expense_models), len(errors), skipped_count)
 
+    # Read straight off the validated models (no model_dump pass); dates stay date objects for orjson to encode
     processed_expenses_for_response = [
-        expense.model_dump(mode='json') for expense in valid_expense_models
+        {"id": None, "date": expense.date, "description": expense.description, "value": expense.value, "in_out": expense.in_out}
+        for expense in valid_expense_models
     ]
 
     return {
@@ -174,53 +435,158 @@ async def add_multiple_expenses_to_db(
         "processed_expenses": processed_expenses_for_response
     }
 
-async def delete_all_expenses(collection: AsyncIOMotorCollection) -> Dict[str, Any]:
-    """Deletes all documents from the specified expense collection."""
+async def delete_all_expenses(collection: AsyncCollection) -> Dict[str, Any]:
+    """
+    Deletes all documents from the specified expense collection by dropping it and recreating its indexes.
+    Dropping is a metadata operation, unlike delete_many({}) which removes (and index-maintains) every document.
+    """
     logger.warning(f"Attempting to delete ALL documents from collection '{collection.name}'.")
     try:
-        result = await collection.delete_many({})
-        deleted_count = result.deleted_count
-        logger.info(f"Successfully deleted {deleted_count} documents from collection '{collection.name}'.")
-        return {"status": "success", "deleted_count": deleted_count}
+        # Metadata count, taken before the drop so the response keeps reporting deleted_count
+        deleted_count = await collection.estimated_document_count()
+        # Stop hinting indexes that are about to disappear until ensure_indexes confirms them again
+        _ensured_indexes.clear()
+        await collection.drop()
+        logger.info(f"Successfully dropped collection '{collection.name}' ({deleted_count} documents).")
     except Exception as e:
-        logger.error(f"Database error during delete_many operation: {e}")
+        logger.error(f"Database error during drop operation: {e}")
         raise ConnectionError(f"Database error deleting expenses: {e}")
+    await ensure_indexes(collection)
+    return {"status": "success", "deleted_count": deleted_count}
 
-async def clear_database(collection: AsyncIOMotorCollection) -> Dict[str, Any]:
+async def clear_database(collection: AsyncCollection) -> Dict[str, Any]:
     """Clears all documents from the specified expense collection."""
     return await delete_all_expenses(collection)
 
 # --- File/Text Processing Functions --- 
 
+def parse_csv_content(binary_file: BinaryIO) -> Optional[List[Dict[str, Any]]]:
+    """
+    Parses a CSV upload line by line straight from the (already spooled) file object.
+    Returns None when the header row lacks the expected columns, so the caller can fall back to the AI agent.
+    """
+    # utf-8-sig drops the byte order mark Excel puts in front of the first header
+    reader = csv.reader(codecs.iterdecode(binary_file, 'utf-8-sig'))
+    header = next(reader, None)
+    if header is None:
+        return []
+    # Last occurrence wins for repeated headers, as with csv.DictReader
+    column_indexes = {name.strip().lower(): index for index, name in enumerate(header)}
+    if not _CSV_REQUIRED_HEADERS.issubset(column_indexes):
+        return None
+
+    # Only the wanted columns are picked (and stripped) per row, instead of building a dict of every column first
+    names = [name for name in _CSV_WANTED_HEADERS if name in column_indexes]
+    indexes = [column_indexes[name] for name in names]
+    pick = operator.itemgetter(*indexes)
+    row_width = max(indexes) + 1
+    rows = []
+    for row in reader:
+        if len(row) >= row_width:
+            rows.append(dict(zip(names, [value.strip() for value in pick(row)])))
+        elif row:
+            # Short rows keep whichever wanted columns they do have
+            rows.append({name: row[index].strip() for name, index in zip(names, indexes) if index < len(row)})
+    return rows
+
+def _sign_sample(binary_file: BinaryIO) -> str:
+    """
+    Returns the header and first rows of a CSV plus rows spread evenly over the rest of the file, so a sign
+    convention that only shows up further down still reaches the analysis. Streams the file in one pass, holding
+    at most 3 x SIGN_SAMPLE_LINES lines, and leaves it rewound.
+    """
+    head, spread, step = [], [], 1
+    for line_number, line in enumerate(binary_file):
+        if line_number < SIGN_SAMPLE_LINES:
+            head.append(line)
+        elif (line_number - SIGN_SAMPLE_LINES) % step == 0:
+            spread.append(line)
+            if len(spread) > 2 * SIGN_SAMPLE_LINES:
+                # Keep every other sampled line and sample half as often from here on
+                spread = spread[::2]
+                step *= 2
+    binary_file.seek(0)
+    return b"".join(head + spread).decode('utf-8-sig', errors='replace')
+
+async def _read_upload_text(file: UploadFile) -> str:
+    """Reads the upload in fixed-size chunks, decoding incrementally instead of buffering the raw bytes first."""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    parts = []
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b'', final=True))
+    return ''.join(parts)
+
+async def _analyze_with_agents(
+    text_content: str,
+    extract: Callable[[str], Awaitable[List[Dict[str, Any]]]]
+) -> Tuple[bool, List[Dict[str, Any]]]:
+    """
+    Runs the sign convention analysis and the extraction concurrently, as they are independent agent calls.
+    determine_sign_convention never raises, so only an extraction error propagates (cancelling the analysis).
+    """
+    sign_task = asyncio.ensure_future(determine_sign_convention(text_content))
+    try:
+        extracted_data = await extract(text_content)
+    except BaseException:
+        sign_task.cancel()
+        raise
+    return await sign_task, extracted_data
+
 async def process_uploaded_file(
-    collection: AsyncIOMotorCollection,
+    collection: AsyncCollection,
     file: UploadFile,
     save_at_front: bool
 ) -> Dict[str, Any]:
     """
     Processes an uploaded file (CSV or TXT).
-    - Reads file content.
-    - Sends content to OpenAI agent for processing.
+    - CSV files with date/description/value headers are parsed locally, row by row.
+    - Any other content is sent to the OpenAI agent for extraction.
     - Validates extracted data.
     - Stores valid data in the database using the provided collection *unless* save_at_front is True.
     - Returns a dictionary summarizing the result including processed data.
     """
-    logger.info(f"Processing uploaded file: {file.filename}, type: {file.content_type}, SaveAtFront: {save_at_front}")
+    logger.info("Processing uploaded file: %s, type: %s, SaveAtFront: %s", file.filename, file.content_type, save_at_front)
     extracted_data = []
     try:
-        content = await file.read()
-        if not content:
-             logger.warning(f"Uploaded file {file.filename} is empty.")
-             return {"status": "error", "message": "File is empty.", "added_count": 0, "processed_count": 0, "errors": ["File is empty."], "processed_expenses": []}
-
         try:
-            text_content = content.decode('utf-8')
-            
-            invert_signs_needed = await determine_sign_convention(text_content)
-            
-            logger.info(f"Extracting expense data from file (will invert signs: {invert_signs_needed})..." )
-            extracted_data = await process_text_with_agent(text_content)
-            logger.info(f"AI agent returned {len(extracted_data)} items from file.")
+            csv_rows = None
+            sign_task = None
+            is_csv = file.content_type == "text/csv" or (file.filename or "").lower().endswith(".csv")
+            if is_csv:
+                # Only a sample is needed for the sign convention analysis; rows are parsed without decoding the whole file
+                sign_sample = await asyncio.to_thread(_sign_sample, file.file)
+                # The analysis only reads the sample, so the agent call runs while the rows are parsed
+                if sign_sample.strip():
+                    sign_task = asyncio.ensure_future(determine_sign_convention(sign_sample))
+                try:
+                    # Parsing is CPU-bound and only touches the spooled file, so it runs in a thread off the event loop
+                    csv_rows = await asyncio.to_thread(parse_csv_content, file.file)
+                except BaseException:
+                    if sign_task is not None:
+                        sign_task.cancel()
+                    raise
+                if csv_rows is None and sign_task is not None:
+                    # Not a structured CSV after all; the agent path analyzes the full text instead
+                    sign_task.cancel()
+
+            if csv_rows is not None:
+                if sign_task is None:
+                    logger.warning(f"Uploaded file {file.filename} is empty.")
+                    return {"status": "error", "message": "File is empty.", "added_count": 0, "processed_count": 0, "errors": ["File is empty."], "processed_expenses": []}
+                invert_signs_needed = await sign_task
+                extracted_data = csv_rows
+                logger.info("Parsed %d rows locally from CSV file (will invert signs: %s).", len(extracted_data), invert_signs_needed)
+            else:
+                await file.seek(0)
+                text_content = await _read_upload_text(file)
+                if not text_content:
+                    logger.warning(f"Uploaded file {file.filename} is empty.")
+                    return {"status": "error", "message": "File is empty.", "added_count": 0, "processed_count": 0, "errors": ["File is empty."], "processed_expenses": []}
+
+                logger.info("Extracting expense data from file...")
+                invert_signs_needed, extracted_data = await _analyze_with_agents(text_content, extract_text_chunked)
+                logger.info("AI agent returned %d items from file (will invert signs: %s).", len(extracted_data), invert_signs_needed)
         except UnicodeDecodeError:
              logger.error(f"Could not decode file {file.filename}. Ensure UTF-8 encoding.")
              raise ValueError("Could not read file. Ensure UTF-8 encoding.")
@@ -229,10 +595,10 @@ async def process_uploaded_file(
             raise
         
         if not extracted_data:
-            logger.info(f"No data extracted from {file.filename}. Nothing to process.")
+            logger.info("No data extracted from %s. Nothing to process.", file.filename)
             return {"status": "success", "message": "No actionable data found in file.", "added_count": 0, "processed_count": 0, "errors": [], "processed_expenses": []}
 
-        logger.info(f"Processing {len(extracted_data)} items from {file.filename} (SaveToDB: {not save_at_front})...")
+        logger.info("Processing %d items from %s (SaveToDB: %s)...", len(extracted_data), file.filename, not save_at_front)
         db_result = await add_multiple_expenses_to_db(
             collection,
             extracted_data,
@@ -249,7 +615,7 @@ async def process_uploaded_file(
         raise ConnectionError(f"Unexpected server error processing file {file.filename}.")
 
 async def process_text_input(
-    collection: AsyncIOMotorCollection,
+    collection: AsyncCollection,
     text_data: str,
     save_at_front: bool
 ) -> Dict[str, Any]:
@@ -260,22 +626,20 @@ async def process_text_input(
     - Stores valid data in the database using the provided collection *unless* save_at_front is True.
     - Returns a dictionary summarizing the result including processed data.
     """
-    logger.info(f"Processing text input (length: {len(text_data)}), SaveAtFront: {save_at_front}...")
+    logger.info("Processing text input (length: %d), SaveAtFront: %s...", len(text_data), save_at_front)
     if not text_data or not text_data.strip():
         logger.warning("Received empty text input.")
         raise ValueError("Text input cannot be empty.")
 
     try:
-        invert_signs_needed = await determine_sign_convention(text_data)
-
-        extracted_data = await process_text_with_agent(text_data)
-        logger.info(f"AI agent returned {len(extracted_data)} items from text input.")
+        invert_signs_needed, extracted_data = await _analyze_with_agents(text_data, extract_text_batched)
+        logger.info("AI agent returned %d items from text input.", len(extracted_data))
         
         if not extracted_data:
             logger.info("AI agent returned no data from text input. Nothing to process.")
             return {"status": "success", "message": "No actionable data found in text.", "added_count": 0, "processed_count": 0, "errors": [], "processed_expenses": []}
 
-        logger.info(f"Processing {len(extracted_data)} items from text input (SaveToDB: {not save_at_front})...")
+        logger.info("Processing %d items from text input (SaveToDB: %s)...", len(extracted_data), not save_at_front)
         db_result = await add_multiple_expenses_to_db(
             collection,
             extracted_data,
@@ -286,6 +650,9 @@ async def process_text_input(
     except ConnectionError as e: 
          logger.error(f"AI/DB Connection error processing text input: {e}")
          raise
+    except ValueError as ve:
+        logger.error(f"ValueError processing text input: {ve}")
+        raise
     except Exception as e:
         logger.exception(f"Unexpected error processing text input: {e}")
         raise ConnectionError("Unexpected server error processing text input.") 
@@ -0,0 +1,125 @@
+"""Background processing of text input through an in-process job queue."""
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import orjson
+from config import settings
+from services import expenses_service
+from utils import cache, database
+
+logger = logging.getLogger(__name__)
+
+JOB_TTL_SECONDS = 3600
+JOB_QUEUE_MAX_SIZE = 100
+LOCAL_JOBS_MAX_SIZE = 1000
+
+# Populated by start_workers() from the FastAPI lifespan handler in main.py
+jobs_state: Dict[str, Any] = {}
+# Fallback job store when Redis is not configured (only visible to this worker process): job id -> (expiry, job),
+# least recently saved first. Entries expire after JOB_TTL_SECONDS like in Redis, and the oldest are evicted
+# beyond LOCAL_JOBS_MAX_SIZE.
+_local_jobs: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+def _save_local_job(job_id: str, job: Dict[str, Any]) -> None:
+    """Stores the job in process memory, dropping expired and excess entries."""
+    now = time.monotonic()
+    _local_jobs[job_id] = (now + JOB_TTL_SECONDS, job)
+    _local_jobs.move_to_end(job_id)
+    # Saves refresh the expiry, so the least recently saved entry always expires first
+    while _local_jobs:
+        oldest_id, (expires_at, _) = next(iter(_local_jobs.items()))
+        if expires_at > now and len(_local_jobs) <= LOCAL_JOBS_MAX_SIZE:
+            break
+        del _local_jobs[oldest_id]
+
+def _get_local_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Returns the in-memory job unless it is unknown or expired."""
+    entry = _local_jobs.get(job_id)
+    if entry is None:
+        return None
+    expires_at, job = entry
+    if expires_at <= time.monotonic():
+        del _local_jobs[job_id]
+        return None
+    return job
+
+async def _save_job(job_id: str, job: Dict[str, Any]) -> None:
+    """Stores the job state in Redis when available, otherwise in process memory."""
+    client = cache.get_redis()
+    if client is not None:
+        try:
+            await client.set(f"jobs:{job_id}", orjson.dumps(job), ex=JOB_TTL_SECONDS)
+            return
+        except Exception as e:
+            logger.warning(f"Redis error saving job {job_id}, keeping it in memory: {e}")
+    _save_local_job(job_id, job)
+
+async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Returns the stored state for a job, or None if it is unknown or expired."""
+    client = cache.get_redis()
+    if client is not None:
+        try:
+            raw_job = await client.get(f"jobs:{job_id}")
+            if raw_job is not None:
+                return orjson.loads(raw_job)
+        except Exception as e:
+            logger.warning(f"Redis error reading job {job_id}: {e}")
+    return _get_local_job(job_id)
+
+async def enqueue_text(text_data: str, save_at_front: bool) -> str:
+    """
+    Queues text input for background processing and returns the new job id.
+    Raises RuntimeError when the workers are not running or the queue is full.
+    """
+    queue: Optional[asyncio.Queue] = jobs_state.get("queue")
+    if queue is None:
+        raise RuntimeError("Text processing workers are not running.")
+    job_id = uuid.uuid4().hex
+    try:
+        queue.put_nowait((job_id, text_data, save_at_front))
+    except asyncio.QueueFull:
+        raise RuntimeError("Text processing queue is full. Try again later.")
+    await _save_job(job_id, {"job_id": job_id, "status": "queued"})
+    logger.info("Queued text processing job %s (length: %d).", job_id, len(text_data))
+    return job_id
+
+async def _worker(worker_index: int, queue: asyncio.Queue) -> None:
+    """Consumes queued text jobs one at a time, storing each job's result or error."""
+    while True:
+        job_id, text_data, save_at_front = await queue.get()
+        try:
+            await _save_job(job_id, {"job_id": job_id, "status": "processing"})
+            collection = database.get_expenses_collection()
+            if collection is None:
+                raise ConnectionError("Database service not available.")
+            result = await expenses_service.process_text_input(collection, text_data, save_at_front=save_at_front)
+            if result.get("added_count"):
+                await cache.invalidate_expenses()
+            await _save_job(job_id, {"job_id": job_id, "status": "completed", "result": result})
+            logger.info("Worker %d completed job %s: %s", worker_index, job_id, result.get('status'))
+        except Exception as e:
+            logger.error("Worker %d failed job %s: %s", worker_index, job_id, e)
+            await _save_job(job_id, {"job_id": job_id, "status": "failed", "error": str(e)})
+        finally:
+            queue.task_done()
+
+def start_workers() -> None:
+    """Creates the job queue and starts TEXT_JOB_WORKERS consumer tasks on the running loop."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=JOB_QUEUE_MAX_SIZE)
+    workers: List[asyncio.Task] = [
+        asyncio.create_task(_worker(index, queue)) for index in range(settings.TEXT_JOB_WORKERS)
+    ]
+    jobs_state["queue"] = queue
+    jobs_state["workers"] = workers
+    logger.info(f"Started {len(workers)} text processing workers.")
+
+async def stop_workers() -> None:
+    """Cancels the consumer tasks; jobs still queued are dropped."""
+    workers = jobs_state.pop("workers", [])
+    jobs_state.pop("queue", None)
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,21 @@
+"""Tests for the local CSV parsing of uploads."""
+import io
+
+from services.expenses_service import parse_csv_content
+
+
+def test_parses_expected_columns():
+    content = b"Date, Description ,Value,Extra\n2024-01-05, Coffee ,-3.50,x\n"
+    rows = parse_csv_content(io.BytesIO(content))
+    assert rows == [{"date": "2024-01-05", "description": "Coffee", "value": "-3.50"}]
+
+
+def test_parses_csv_with_utf8_bom():
+    # Excel exports start with a byte order mark, which must not hide the first header
+    content = b"\xef\xbb\xbfDate,Description,Value\n2024-01-05,Coffee,-3.50\n"
+    rows = parse_csv_content(io.BytesIO(content))
+    assert rows == [{"date": "2024-01-05", "description": "Coffee", "value": "-3.50"}]
+
+
+def test_returns_none_without_expected_headers():
+    assert parse_csv_content(io.BytesIO(b"foo,bar\n1,2\n")) is None
@@ -0,0 +1,27 @@
+"""Tests for requests short-circuited by FastPathMiddleware."""
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+def test_health_is_served():
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json()["status"] == "ok"
+
+
+def test_wrong_method_on_health_is_405():
+    assert client.post("/health").status_code == 405
+    assert client.head("/health").status_code == 405
+
+
+def test_wrong_method_on_favicon_is_405():
+    assert client.post("/favicon.ico").status_code == 405
+
+
+def test_missing_fast_path_is_404(monkeypatch):
+    # Stands in for /favicon.ico with SERVE_STATIC=false: a fast path nothing serves must 404, not fail with a 500
+    monkeypatch.setattr(main, "_FAST_PATHS", main._FAST_PATHS | {"/missing-fast-path"})
+    assert client.get("/missing-fast-path").status_code == 404
@@ -0,0 +1,40 @@
+"""Tests for the upload size limit enforced by LimitUploadSizeMiddleware."""
+from fastapi.testclient import TestClient
+
+from main import MAX_UPLOAD_SIZE, app
+
+client = TestClient(app)
+OVERSIZED_BODY = b"x" * (MAX_UPLOAD_SIZE + 1)
+
+
+def test_oversized_upload_is_rejected():
+    response = client.post("/api/upload-file", content=OVERSIZED_BODY)
+    assert response.status_code == 413
+
+
+def test_oversized_upload_on_percent_encoded_path_is_rejected():
+    # "%65" decodes to "e": the router matches this path to the upload endpoint, so the limit must apply too
+    response = client.post("/api/upload-fil%65", content=OVERSIZED_BODY)
+    assert response.status_code == 413
+
+
+
+def test_oversized_chunked_upload_is_rejected():
+    # A generator body is sent with Transfer-Encoding: chunked, so there is no Content-Length to check up front
+    boundary = "limit-test"
+
+    def body():
+        yield (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="big.csv"\r\n'
+            "Content-Type: text/csv\r\n\r\n"
+        ).encode()
+        for _ in range(3):
+            yield b"x" * (MAX_UPLOAD_SIZE // 2)
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    response = client.post(
+        "/api/upload-file",
+        content=body(),
+        headers={"content-type": f"multipart/form-data; boundary={boundary}"},
+    )
+    assert response.status_code == 413
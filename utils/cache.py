@@ -0,0 +1,80 @@
+"""Optional Redis cache for expense listings, enabled by setting REDIS_URL."""
+import logging
+from typing import Any, Dict, Optional
+from redis import asyncio as aioredis
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+EXPENSES_CACHE_TTL = 300
+EXPENSES_VERSION_KEY = "expenses:version"
+
+# Populated by the FastAPI lifespan handler in main.py
+cache_state: Dict[str, Any] = {}
+
+def connect() -> None:
+    """Creates the Redis client when REDIS_URL is configured; caching stays disabled otherwise."""
+    if settings.REDIS_URL:
+        cache_state["redis"] = aioredis.from_url(settings.REDIS_URL)
+        logger.info("Redis cache enabled for expense listings.")
+    else:
+        logger.info("REDIS_URL not set. Expense listing cache disabled.")
+
+async def close() -> None:
+    """Closes the Redis client, if one was created."""
+    client = cache_state.pop("redis", None)
+    if client is not None:
+        await client.aclose()
+
+def get_redis() -> Optional[aioredis.Redis]:
+    """Returns the Redis client, or None when caching is disabled."""
+    return cache_state.get("redis")
+
+def _expenses_key(version: int, sort_by: str, sort_order: int, skip: int, limit: Optional[int]) -> str:
+    """Builds the listing key from the data version so writes never need to enumerate keys."""
+    return f"expenses:{version}:{sort_by}:{sort_order}:{skip}:{limit or 'all'}"
+
+async def get_expenses_version() -> Optional[int]:
+    """Returns the current expenses data version, or None when caching is disabled or Redis is unreachable."""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        return int(await client.get(EXPENSES_VERSION_KEY) or 0)
+    except Exception as e:
+        logger.warning(f"Redis error reading expenses version: {e}")
+        return None
+
+async def get_expenses_listing(version: int, sort_by: str, sort_order: int, skip: int = 0, limit: Optional[int] = None) -> Optional[bytes]:
+    """Returns the cached JSON listing for the given version, sort and page, or None on a miss or when caching is disabled."""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        return await client.get(_expenses_key(version, sort_by, sort_order, skip, limit))
+    except Exception as e:
+        logger.warning(f"Redis error reading expense listing cache: {e}")
+        return None
+
+async def set_expenses_listing(version: int, sort_by: str, sort_order: int, body: bytes, skip: int = 0, limit: Optional[int] = None) -> None:
+    """
+    Stores the serialized listing under the version read before the query, so a write that lands
+    meanwhile leaves this entry unreachable instead of caching stale data under the new version.
+    """
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        await client.set(_expenses_key(version, sort_by, sort_order, skip, limit), body, ex=EXPENSES_CACHE_TTL, nx=True)
+    except Exception as e:
+        logger.warning(f"Redis error writing expense listing cache: {e}")
+
+async def invalidate_expenses() -> None:
+    """Bumps the data version so every cached listing becomes unreachable (and expires on its own)."""
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        await client.incr(EXPENSES_VERSION_KEY)
+    except Exception as e:
+        logger.warning(f"Redis error invalidating expense listing cache: {e}")
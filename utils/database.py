@@ -0,0 +1,53 @@
+"""Shared MongoDB handles bound once at application startup."""
+import asyncio
+import threading
+import weakref
+from functools import lru_cache
+from typing import Any, Dict, Optional
+from pymongo import AsyncMongoClient
+from pymongo.asynchronous.collection import AsyncCollection
+from config import settings
+
+# Populated by the FastAPI lifespan handler in main.py
+app_state: Dict[str, Any] = {}
+
+# Async MongoDB clients are bound to the event loop they were first used on, so keep one per loop
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncMongoClient]" = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+def get_client() -> AsyncMongoClient:
+    """Returns the MongoDB client for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(loop)
+            if client is None:
+                client = AsyncMongoClient(
+                    settings.MONGODB_URI,
+                    maxPoolSize=settings.MONGO_MAX_POOL,
+                    minPoolSize=settings.MONGO_MIN_POOL,
+                    maxIdleTimeMS=300_000,
+                    maxConnecting=settings.MONGO_MAX_CONNECTING,
+                    serverSelectionTimeoutMS=5000,
+                    retryWrites=True,
+                )
+                _clients[loop] = client
+    return client
+
+async def close_client() -> None:
+    """Closes and forgets the MongoDB client bound to the running event loop, if any."""
+    with _clients_lock:
+        client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+@lru_cache(maxsize=1)
+def get_expenses_collection() -> Optional[AsyncCollection]:
+    """Returns the expenses collection bound at startup, or None if MongoDB is unavailable."""
+    return app_state.get("expenses_collection")
+
+def is_mongo_ready() -> bool:
+    """Returns True once MongoDB has answered the background startup ping."""
+    ready = app_state.get("mongo_ready")
+    return ready is not None and ready.is_set()